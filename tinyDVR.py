@@ -13,13 +13,29 @@ Tested on macOS/Linux (needs ffmpeg installed).
 import os
 import sys
 import time
+import csv
 import json
+import logging
+import select
 import signal
+import threading
 import subprocess
+from collections import deque
 from datetime import datetime
+from operator import itemgetter
 from urllib.parse import quote
 
-import psutil
+try:
+    # Optional: per-process CPU/RAM sampling (ENABLE_RESOURCE_LOG)
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    # Optional (Linux only): event-driven segment tracking instead of polling
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 
 # ----------------------------
@@ -37,6 +53,10 @@ CAM_PATH = "/stream1"         # change if needed (e.g., /stream2)
 OUTPUT_DIR = "./recordings"
 SEGMENT_SECONDS = 60          # each file duration
 MAX_STORAGE_GB = 10           # hard cap, old files auto-deleted
+# Without inotify, ffmpeg also appends one ~40-byte row per closed segment to this csv
+# so the monitor doesn't have to rescan the folder. It is rewritten on every ffmpeg
+# (re)start and is not counted against MAX_STORAGE_GB (~20 KB/day at 60 s segments).
+SEGMENT_LIST_NAME = "segments.csv"
 
 # Monitoring / restart behavior
 CHECK_EVERY_SECONDS = 10
@@ -46,8 +66,23 @@ RESTART_BACKOFF_SECONDS = 5        # avoid restart spam
 # RTSP transport: try "tcp" (recommended). If unstable, try "udp".
 RTSP_TRANSPORT = "tcp"
 
+# Video codec: "-c:v copy" whenever the camera codec can go straight into MP4 (the normal case).
+# Set False to skip the one-time ffprobe check and always copy.
+PROBE_SOURCE_CODEC = True
+
+# FFmpeg scheduling (Linux). CPU_AFFINITY pins ffmpeg to these cores, e.g. {1} on a
+# Raspberry Pi so the monitor keeps core 0; None leaves it unpinned.
+# IO_NICE sets best-effort I/O priority 0 (high) .. 7 (low), e.g. 7 so storage-cap
+# deletes don't starve an SD card; None leaves it alone. Linux only, needs psutil.
+CPU_AFFINITY = None
+IO_NICE = None
+
 # Resource reporting
-ENABLE_RESOURCE_LOG = True
+# ffmpeg's own progress (frames, dropped frames) is always reported in status.json.
+# Set True to also sample ffmpeg CPU/RAM via psutil (needs `pip install psutil`).
+ENABLE_RESOURCE_LOG = False
+LOG_LEVEL = "INFO"                 # "WARNING" silences the per-check health line
+STATUS_PRETTY_JSON = False         # indent status.json for humans (tools parse either form)
 
 
 # ----------------------------
@@ -58,6 +93,48 @@ ENABLE_RESOURCE_LOG = True
 RTSP_URL = f"rtsp://{quote(CAM_USER)}:{quote(CAM_PASS)}@{CAM_HOST}:{CAM_PORT}{CAM_PATH}"
 
 
+# ----------------------------
+# Logging
+# ----------------------------
+
+log = logging.getLogger("dvr")
+
+_MB = 1024 * 1024
+# Codecs the MP4 muxer accepts as-is, so "-c:v copy" works without re-encoding
+_MP4_COPY_CODECS = ("h264", "hevc", "mpeg4", "av1")
+
+# Hardware H.264 encoders tried in order if the source can't be copied into MP4
+_HW_ENCODERS = (
+    ("h264_videotoolbox", ["-c:v", "h264_videotoolbox"]),
+    ("h264_v4l2m2m", ["-c:v", "h264_v4l2m2m"]),
+    ("h264_vaapi", ["-vaapi_device", "/dev/dri/renderD128", "-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi"]),
+)
+_SW_ENCODER = ["-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency"]
+
+_HEALTH_LOG = "[health] recording=%s reason=%s folder=%.1fMB"
+_HEALTH_LOG_PROGRESS = _HEALTH_LOG + " frame=%s drop=%s"
+_HEALTH_LOG_RES = _HEALTH_LOG_PROGRESS + " cpu=%s mem=%.1fMB"
+
+# ffmpeg -progress keys that are numeric; everything else is kept as a string.
+# (ffmpeg's "out_time_ms" is actually microseconds too, so only out_time_us is used.)
+_PROGRESS_INT_KEYS = ("frame", "drop_frames", "dup_frames", "out_time_us", "total_size")
+
+
+# ----------------------------
+# Segment index (seeded once, updated incrementally)
+# ----------------------------
+
+_index = deque()       # (full_path, mtime_ns, size_bytes), oldest -> newest
+_index_sizes = {}      # full_path -> size_bytes currently counted in _total_bytes
+_total_bytes = 0
+_index_dir_mtime = -1  # output_dir st_mtime_ns at the last full scan, -1 = unknown
+
+# A directory's mtime only changes when entries are created/removed/renamed, so an
+# unchanged value means no new segments. Trusted only once it is this old, to
+# allow for coarse filesystem timestamps (FAT keeps 2 s).
+_DIR_MTIME_SLACK_NS = 2_000_000_000
+
+
 # ----------------------------
 # Helpers
 # ----------------------------
@@ -70,81 +147,439 @@ def bytes_from_gb(gb: float) -> int:
     return int(gb * 1024 * 1024 * 1024)
 
 
+def iter_recording_files(output_dir: str):
+    """
+    Yields (full_path, mtime_ns, size_bytes) for .mp4 segment files, unsorted.
+    """
+    try:
+        # scandir hands back DirEntry.path directly and avoids a join + re-resolve per file
+        with os.scandir(output_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".mp4"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return
+
+
 def list_recording_files(output_dir: str):
     """
-    Returns list of (full_path, mtime, size_bytes) for .mp4 segment files.
-    Sorted oldest -> newest.
+    Returns (files, total_bytes) where files is a list of
+    (full_path, mtime_ns, size_bytes) for .mp4 segment files, sorted oldest -> newest.
     """
     files = []
+    total = 0
+    for entry in iter_recording_files(output_dir):
+        files.append(entry)
+        total += entry[2]
+    files.sort(key=itemgetter(1))
+    return files, total
+
+
+def _index_drop(path: str) -> None:
+    """
+    Remove path from the index. Mostly used for the still-growing newest
+    segments, so search from the right.
+    """
+    global _total_bytes
+    for i in range(len(_index) - 1, -1, -1):
+        if _index[i][0] == path:
+            del _index[i]
+            break
+    _total_bytes -= _index_sizes.pop(path)
+
+
+def _index_push(path: str, mtime: int, size: int) -> None:
+    global _total_bytes
+    _index.append((path, mtime, size))
+    _index_sizes[path] = size
+    _total_bytes += size
+
+
+def _dir_mtime(output_dir: str) -> int:
+    """
+    st_mtime_ns of output_dir if it is old enough to serve as a change marker,
+    else -1 so the next update always rescans.
+    """
     try:
-        for name in os.listdir(output_dir):
-            if name.endswith(".mp4"):
-                p = os.path.join(output_dir, name)
-                try:
-                    st = os.stat(p)
-                    files.append((p, st.st_mtime, st.st_size))
-                except FileNotFoundError:
-                    pass
+        dm = os.stat(output_dir).st_mtime_ns
     except FileNotFoundError:
-        return []
+        return -1
+    return dm if time.time_ns() - dm > _DIR_MTIME_SLACK_NS else -1
 
-    files.sort(key=lambda x: x[1])
-    return files
 
+def seed_index(output_dir: str) -> None:
+    """
+    Full scan of output_dir to (re)build the segment index.
+    """
+    global _total_bytes, _index_dir_mtime
+    # Read the marker before scanning so a file created mid-scan still invalidates it
+    _index_dir_mtime = _dir_mtime(output_dir)
+    files, total = list_recording_files(output_dir)
+    _index.clear()
+    _index.extend(files)
+    _index_sizes.clear()
+    _index_sizes.update((p, sz) for p, _, sz in files)
+    _total_bytes = total
 
-def folder_size_bytes(output_dir: str) -> int:
-    return sum(sz for _, _, sz in list_recording_files(output_dir))
 
+def folder_size_bytes() -> int:
+    return _total_bytes
 
-def newest_recording_mtime(output_dir: str):
-    files = list_recording_files(output_dir)
-    if not files:
+
+def update_index(output_dir: str) -> int:
+    """
+    Add segments written since the last update. Entries older than the newest
+    indexed mtime are skipped; the segment ffmpeg is still writing gets its
+    size refreshed. Indexed segments missing from the scan (deleted or moved
+    away by something else) are dropped so _total_bytes matches the disk.
+    Skips the scan entirely if the directory itself hasn't changed since the
+    last one. Returns number of new/updated/dropped entries.
+    """
+    global _index_dir_mtime
+    dm = _dir_mtime(output_dir)
+    if dm != -1 and dm == _index_dir_mtime:
+        return 0
+    _index_dir_mtime = dm
+
+    newest = _index[-1][1] if _index else -1
+    seen = set()
+    changed = []
+    for p, mtime, sz in iter_recording_files(output_dir):
+        seen.add(p)
+        if mtime >= newest and _index_sizes.get(p) != sz:
+            changed.append((p, mtime, sz))
+
+    gone = [p for p in _index_sizes if p not in seen]
+    for p in gone:
+        _index_drop(p)
+
+    # Every changed entry is at least as new as the current tail, so
+    # re-appending in mtime order keeps the index sorted.
+    changed.sort(key=itemgetter(1))
+    for p, mtime, sz in changed:
+        if p in _index_sizes:
+            _index_drop(p)
+        _index_push(p, mtime, sz)
+    return len(changed) + len(gone)
+
+
+def segment_base(output_dir: str) -> str:
+    """
+    output_dir with a trailing separator, computed once so segment paths can be
+    built as base + name instead of os.path.join per file.
+    """
+    return os.path.join(output_dir, "")
+
+
+def index_segment(base: str, name: str) -> bool:
+    """
+    Stat a single segment (from inotify or the segment list) and add/refresh it in the index.
+    `base` comes from segment_base(). Returns True if the index changed.
+    """
+    return _index_refresh(base + name)
+
+
+def _index_refresh(p: str) -> bool:
+    global _total_bytes
+    try:
+        st = os.stat(p)
+    except FileNotFoundError:
+        return False
+    if p not in _index_sizes:
+        _index_push(p, st.st_mtime_ns, st.st_size)
+        return True
+
+    # Already indexed (CREATE seen earlier): refresh in place to keep ordering
+    for i in range(len(_index) - 1, -1, -1):
+        if _index[i][0] == p:
+            if _index[i][1] == st.st_mtime_ns and _index[i][2] == st.st_size:
+                return False
+            _index[i] = (p, st.st_mtime_ns, st.st_size)
+            break
+    _total_bytes += st.st_size - _index_sizes[p]
+    _index_sizes[p] = st.st_size
+    return True
+
+
+def forget_segment(base: str, name: str) -> bool:
+    """
+    Drop a segment that was deleted or moved out of the folder (inotify
+    DELETE / MOVED_FROM). Returns True if it was indexed.
+    """
+    p = base + name
+    if p not in _index_sizes:
+        return False  # e.g. our own retention delete, already popped
+    _index_drop(p)
+    return True
+
+
+def refresh_newest() -> bool:
+    """
+    Re-stat only the newest indexed segment (the one ffmpeg is writing), so the
+    health check sees progress between segment close events.
+    Returns True if it grew (i.e. is still being written).
+    """
+    if _index:
+        return _index_refresh(_index[-1][0])
+    return False
+
+
+def read_segment_list(f) -> list:
+    """
+    Return segment filenames ffmpeg appended to its csv segment list
+    (filename,start,end per closed segment) since the last read.
+    `f` is the list file opened in binary mode.
+    """
+    if os.fstat(f.fileno()).st_size < f.tell():
+        f.seek(0)  # ffmpeg restarted and truncated the list
+
+    lines = []
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        if not line.endswith(b"\n"):
+            f.seek(-len(line), os.SEEK_CUR)  # partial row, pick it up next time
+            break
+        lines.append(line.decode("utf-8", errors="replace"))
+
+    return [os.path.basename(row[0]) for row in csv.reader(lines) if row]
+
+
+def open_segment_watch(output_dir: str):
+    """
+    Returns an INotify watching output_dir for segment create/close/removal, or None
+    if inotify_simple is unavailable (non-Linux) so the caller falls back to polling.
+    """
+    if INotify is None:
+        return None
+    try:
+        watch = INotify()
+        watch.add_watch(
+            output_dir,
+            inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+            | inotify_flags.DELETE | inotify_flags.MOVED_FROM,
+        )
+        return watch
+    except OSError as e:
+        log.warning("[start] inotify unavailable (%s), falling back to polling.", e)
+        return None
+
+
+def open_child_wakeup():
+    """
+    Self-pipe that becomes readable as soon as ffmpeg exits (SIGCHLD), so the
+    monitor restarts it right away instead of at the next heartbeat.
+    Returns the read end, or None where SIGCHLD doesn't exist (Windows).
+    """
+    if not hasattr(signal, "SIGCHLD"):
         return None
-    return files[-1][1]
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    os.set_blocking(w, False)
+    signal.set_wakeup_fd(w)
+    # A Python-level handler is required for the wakeup fd to be written
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    return r
 
 
-def enforce_storage_cap(output_dir: str, max_bytes: int) -> int:
+def wait_for_activity(watch, wakeup_fd, timeout: float) -> list:
     """
-    Delete oldest segment files until total folder size <= max_bytes.
-    Returns number of files deleted in this pass.
+    Block until inotify has segment (.mp4) events, a child exited, or timeout
+    elapsed. Other events in the folder (our own status.json writes) don't end
+    the wait. Returns pending segment events (empty list without a watch).
     """
-    files = list_recording_files(output_dir)
-    total = sum(sz for _, _, sz in files)
+    fds = [fd for fd in (watch.fileno() if watch is not None else None, wakeup_fd) if fd is not None]
+    if not fds:
+        time.sleep(timeout)
+        return []
+
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return []
+        ready, _, _ = select.select(fds, [], [], remaining)
+        woken = False
+        if wakeup_fd is not None and wakeup_fd in ready:
+            woken = True
+            try:
+                while os.read(wakeup_fd, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        events = []
+        if watch is not None and watch.fileno() in ready:
+            events = [e for e in watch.read(timeout=0) if e.name.endswith(".mp4")]
+        if events or woken or not ready:
+            return events
+
+
+def enforce_storage_cap(base: str, max_bytes: int) -> int:
+    """
+    Delete oldest indexed segment files until total folder size <= max_bytes.
+    `base` comes from segment_base(). Returns number of files deleted in this pass.
+    """
+    global _total_bytes
     deleted = 0
+    if _total_bytes <= max_bytes:
+        return deleted
 
-    while total > max_bytes and files:
-        p, _, sz = files.pop(0)  # oldest
+    # unlinkat() relative to one open directory fd skips the full path walk per file
+    dfd = None
+    if os.unlink in os.supports_dir_fd:
         try:
-            os.remove(p)
-            deleted += 1
-            total -= sz
-            print(f"[storage] Deleted old file: {os.path.basename(p)}")
-        except FileNotFoundError:
+            dfd = os.open(base, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        except OSError:
             pass
-        except Exception as e:
-            print(f"[storage] Failed to delete {p}: {e}")
-            break
+
+    try:
+        while _total_bytes > max_bytes and _index:
+            p, _, sz = _index[0]  # oldest
+            name = p[len(base):]
+            try:
+                if dfd is not None:
+                    os.unlink(name, dir_fd=dfd)
+                else:
+                    os.remove(p)
+                deleted += 1
+                log.info("[storage] Deleted old file: %s", name)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                log.error("[storage] Failed to delete %s: %s", p, e)
+                break
+            _index.popleft()
+            _total_bytes -= _index_sizes.pop(p)
+    finally:
+        if dfd is not None:
+            os.close(dfd)
 
     return deleted
 
 
-def write_status(output_dir: str, status: dict) -> None:
+def status_paths(output_dir: str):
+    """
+    Returns the (tmp, final) status.json path pair, fs-encoded once for write_status.
+    """
+    return (
+        os.fsencode(os.path.join(output_dir, "status.json.tmp")),
+        os.fsencode(os.path.join(output_dir, "status.json")),
+    )
+
+
+def write_status(paths: tuple, status: dict) -> None:
     """
     Writes status.json atomically so other tools can read it safely.
+    `paths` is the pair from status_paths().
     """
-    tmp = os.path.join(output_dir, "status.json.tmp")
-    final = os.path.join(output_dir, "status.json")
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(status, f, indent=2)
+    tmp, final = paths
+    if STATUS_PRETTY_JSON:
+        buf = json.dumps(status, indent=2).encode("utf-8")
+    else:
+        buf = json.dumps(status, separators=(",", ":")).encode("utf-8")
+
+    # One buffer, one write() - json.dump to a text file issues many small writes
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, buf)
+    finally:
+        os.close(fd)
     os.replace(tmp, final)
 
 
-def build_ffmpeg_command(rtsp_url: str, output_dir: str, segment_seconds: int, transport: str):
+def probe_video_codec(rtsp_url: str, transport: str):
+    """
+    One-time ffprobe of the first video stream.
+    Returns its codec_name, or None if the probe failed.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-rtsp_transport", transport,
+        "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name",
+        "-of", "csv=p=0",
+        rtsp_url,
+    ]
+    try:
+        res = subprocess.run(cmd, capture_output=True, text=True, timeout=20)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.warning("[start] ffprobe failed (%s), assuming the stream can be copied.", e)
+        return None
+
+    if res.returncode != 0:
+        err = "\n".join(res.stderr.strip().splitlines()[-10:]) or "(no stderr)"
+        log.warning("[start] ffprobe exited with %s, assuming the stream can be copied. stderr tail:\n%s",
+                    res.returncode, err)
+        return None
+
+    row = next(csv.reader(res.stdout.strip().splitlines()), [])
+    return row[0] if row else None
+
+
+def available_encoders() -> set:
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10
+        ).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return set()
+    # Lines look like " V..... h264_vaapi   H.264/AVC (VAAPI) (codec h264)"
+    return {parts[1] for parts in (line.split() for line in out.splitlines()) if len(parts) > 1}
+
+
+def encoder_works(args: list) -> bool:
+    """
+    One-frame trial encode. Builds list hardware encoders (v4l2m2m, vaapi) even
+    on machines without the device, where ffmpeg would fail to open them.
+    """
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "nullsrc=s=256x256",
+        "-frames:v", "1",
+        *args,
+        "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=15).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def video_codec_args(codec: str) -> list:
+    """
+    "-c:v copy" when the source codec can be muxed into MP4 (or couldn't be probed).
+    Otherwise pick a hardware H.264 encoder, falling back to libx264.
+    """
+    if codec is None or codec in _MP4_COPY_CODECS:
+        args = ["-c:v", "copy"]
+        if codec == "hevc":
+            args += ["-tag:v", "hvc1"]  # lets Apple players open HEVC MP4s
+        return args
+
+    encoders = available_encoders()
+    for name, args in _HW_ENCODERS:
+        if name in encoders and encoder_works(args):
+            log.warning("[start] Source codec %s can't be copied into MP4; re-encoding with %s.", codec, name)
+            return args
+    log.warning("[start] Source codec %s can't be copied into MP4; re-encoding with libx264 (high CPU).", codec)
+    return _SW_ENCODER
+
+
+def build_ffmpeg_command(rtsp_url: str, output_dir: str, segment_seconds: int, transport: str,
+                         video_args: list = None, segment_list: bool = True):
     """
     FFmpeg command tuned for:
-    - low CPU (copy video, no re-encode)
-    - camera timestamp weirdness (genpts + wallclock timestamps)
+    - low CPU (copy video, no re-encode, unless video_args says otherwise)
+    - camera timestamp weirdness (genpts, normalized only at segment boundaries)
     - time-based segment filenames (strftime)
+    - a csv list of closed segments (if segment_list) so the polling monitor
+      doesn't have to rescan the folder
     - stability with RTSP
     """
     out_pattern = os.path.join(output_dir, "%Y-%m-%d_%H-%M-%S.mp4")
@@ -153,31 +588,49 @@ def build_ffmpeg_command(rtsp_url: str, output_dir: str, segment_seconds: int, t
         "ffmpeg",
         "-hide_banner",
         "-loglevel", "warning",
+        # key=value telemetry on stdout, read by the monitor instead of /proc sampling
+        "-progress", "pipe:1",
+        "-nostats",
 
         "-rtsp_transport", transport,
 
-        # Helps with "non monotonically increasing dts" from some cameras
-        "-fflags", "+genpts",
-        "-use_wallclock_as_timestamps", "1",
+        # Helps with "non monotonically increasing dts" from some cameras.
+        # Input DTS is trusted as-is (no per-packet wallclock rewrite).
+        "-fflags", "+genpts+discardcorrupt",
 
         "-i", rtsp_url,
 
+        "-avoid_negative_ts", "make_zero",
+        "-copyts",
+
         # Minimal CPU & fewer muxing issues:
-        # Drop audio because camera audio is pcm_alaw (G.711) which is awkward in MP4.
-        "-an",
-        "-c:v", "copy",
+        # Video only - camera audio is pcm_alaw (G.711) which is awkward in MP4.
+        "-map", "0:v:0",
+        *(video_args or ["-c:v", "copy"]),
 
         # Segment output into fixed-time chunks
         "-f", "segment",
         "-segment_time", str(segment_seconds),
+        "-segment_format", "mp4",
+        # Fragmented MP4: atoms are written as frames arrive, so there is no
+        # moov rewrite (CPU/IO spike) each time a segment closes.
+        "-segment_format_options", "movflags=+frag_keyframe+empty_moov+default_base_moof",
+        "-flush_packets", "0",
         "-reset_timestamps", "1",
         "-strftime", "1",
         out_pattern
     ]
 
+    if segment_list:
+        cmd[-1:-1] = [
+            "-segment_list", os.path.join(output_dir, SEGMENT_LIST_NAME),
+            "-segment_list_type", "csv",
+            "-segment_list_flags", "+live",
+        ]
+
     # NOTE (If you want audio):
-    # Replace the "-an" line above with:
-    #   "-c:v", "copy",
+    # Add after the "-map", "0:v:0" line above:
+    #   "-map", "0:a:0",
     #   "-c:a", "aac",
     #   "-b:a", "64k",
     # This adds some CPU but keeps audio playable in MP4.
@@ -185,16 +638,92 @@ def build_ffmpeg_command(rtsp_url: str, output_dir: str, segment_seconds: int, t
     return cmd
 
 
-def tail_stderr(proc: subprocess.Popen, max_lines: int = 60) -> str:
+def _drain_stderr(pipe, ring: deque) -> None:
+    for line in pipe:
+        ring.append(line.decode("utf-8", errors="replace").rstrip())
+
+
+def _read_progress(pipe, progress: dict) -> None:
+    """
+    Parse ffmpeg `-progress` output. Each block of key=value lines ends with
+    progress=continue|end; the finished block is merged into `progress` in one
+    dict.update so the monitor never sees a half-written block.
+    """
+    block = {}
+    for line in pipe:
+        key, sep, value = line.decode("utf-8", errors="replace").strip().partition("=")
+        if not sep:
+            continue
+        if key in _PROGRESS_INT_KEYS:
+            try:
+                value = int(value)
+            except ValueError:
+                value = None
+        block[key] = value
+        if key == "progress":
+            progress.update(block)
+            block = {}
+
+
+def start_ffmpeg(ffmpeg_cmd: list, max_lines: int = 60):
+    """
+    Start ffmpeg with daemon threads draining its pipes: stderr into a bounded
+    ring buffer (so a chatty camera can never fill the pipe and block ffmpeg),
+    and stdout `-progress` telemetry into a dict.
+    Returns (proc, stderr_ring, stderr_thread, progress).
+    """
+    proc = subprocess.Popen(
+        ffmpeg_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    ring = deque(maxlen=max_lines)
+    reader = threading.Thread(target=_drain_stderr, args=(proc.stderr, ring), daemon=True)
+    reader.start()
+    progress = {}
+    threading.Thread(target=_read_progress, args=(proc.stdout, progress), daemon=True).start()
+    return proc, ring, reader, progress
+
+
+def tail_stderr(ring: deque, reader: threading.Thread = None) -> str:
+    """
+    Return the last buffered stderr lines for debugging. If the reader thread
+    is given, wait briefly for it to hit EOF so the final lines are included.
+    """
+    if reader is not None:
+        reader.join(timeout=1)
+    return "\n".join(line for line in ring if line)
+
+
+def open_process_handle(pid: int):
     """
-    Read remaining stderr and return last max_lines for debugging.
+    Persistent psutil handle for ffmpeg, with cpu_percent primed so the first
+    real sample is a delta. Returns None if the process is already gone.
     """
     try:
-        err = proc.stderr.read() if proc.stderr else ""
-    except Exception:
-        err = ""
-    lines = err.strip().splitlines()
-    return "\n".join(lines[-max_lines:]) if lines else ""
+        p = psutil.Process(pid)
+        p.cpu_percent(interval=None)
+        return p
+    except psutil.Error:
+        return None
+
+
+def tune_ffmpeg_process(pid: int) -> None:
+    """
+    Apply CPU_AFFINITY / IO_NICE to a freshly started ffmpeg. Best effort:
+    unsupported platforms and permission errors are logged and ignored.
+    """
+    if CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(pid, CPU_AFFINITY)
+        except OSError as e:
+            log.warning("[start] Could not set ffmpeg CPU affinity %s: %s", CPU_AFFINITY, e)
+
+    if IO_NICE is not None and psutil is not None and hasattr(psutil, "IOPRIO_CLASS_BE"):
+        try:
+            psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_BE, IO_NICE)
+        except (psutil.Error, OSError) as e:
+            log.warning("[start] Could not set ffmpeg I/O priority: %s", e)
 
 
 # ----------------------------
@@ -202,27 +731,46 @@ def tail_stderr(proc: subprocess.Popen, max_lines: int = 60) -> str:
 # ----------------------------
 
 def main():
+    logging.basicConfig(level=LOG_LEVEL, format="%(message)s", stream=sys.stdout)
     ensure_dir(OUTPUT_DIR)
+    output_dir_abs = os.path.abspath(OUTPUT_DIR)
+    output_base = segment_base(OUTPUT_DIR)
+    status_files = status_paths(OUTPUT_DIR)
 
     max_bytes = bytes_from_gb(MAX_STORAGE_GB)
-    ffmpeg_cmd = build_ffmpeg_command(RTSP_URL, OUTPUT_DIR, SEGMENT_SECONDS, RTSP_TRANSPORT)
+    no_progress_timeout_ns = NO_PROGRESS_TIMEOUT_SECONDS * 1_000_000_000
+
+    video_args = None
+    if PROBE_SOURCE_CODEC:
+        codec = probe_video_codec(RTSP_URL, RTSP_TRANSPORT)
+        log.info("[start] Source video: codec=%s", codec)
+        video_args = video_codec_args(codec)
+    # inotify already reports segment names, so ffmpeg's csv list is only needed when polling
+    watch = open_segment_watch(OUTPUT_DIR)
+    ffmpeg_cmd = build_ffmpeg_command(
+        RTSP_URL, OUTPUT_DIR, SEGMENT_SECONDS, RTSP_TRANSPORT, video_args, segment_list=watch is None
+    )
 
-    print("[start] RTSP URL (encoded):", RTSP_URL)
-    print("[start] Running FFmpeg command:")
-    print("        " + " ".join(ffmpeg_cmd))
+    log.info("[start] RTSP URL (encoded): %s", RTSP_URL)
+    log.info("[start] Running FFmpeg command:\n        %s", " ".join(ffmpeg_cmd))
 
-    proc = subprocess.Popen(
-        ffmpeg_cmd,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1
-    )
+    if IO_NICE is not None and psutil is None and sys.platform.startswith("linux"):
+        log.warning("[start] IO_NICE is set but psutil is not installed; ffmpeg keeps the default I/O priority.")
+
+    proc, stderr_ring, stderr_reader, progress = start_ffmpeg(ffmpeg_cmd)
+    tune_ffmpeg_process(proc.pid)
+    resource_log = ENABLE_RESOURCE_LOG and psutil is not None
+    if ENABLE_RESOURCE_LOG and not resource_log:
+        log.warning("[start] ENABLE_RESOURCE_LOG is set but psutil is not installed; skipping CPU/RAM stats.")
+    ffmpeg_psutil = open_process_handle(proc.pid) if resource_log else None
 
+    segment_list = None
+    seed_index(OUTPUT_DIR)
     last_ok_time = time.time()
+    last_state = None
 
     def shutdown(*_):
-        print("\n[stop] Shutting down...")
+        log.info("[stop] Shutting down...")
         try:
             proc.terminate()
             try:
@@ -234,16 +782,41 @@ def main():
 
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
+    wakeup_fd = open_child_wakeup()
 
-    print("[start] Recording loop started.")
+    log.info("[start] Recording loop started.")
 
     while True:
-        time.sleep(CHECK_EVERY_SECONDS)
+        # Wait for segment events, ffmpeg exiting, or the heartbeat timeout
+        events = wait_for_activity(watch, wakeup_fd, CHECK_EVERY_SECONDS)
+        if watch is not None:
+            new_segments = 0
+            for event in events:  # wait_for_activity only returns .mp4 events
+                if event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                    changed = forget_segment(output_base, event.name)
+                else:
+                    changed = index_segment(output_base, event.name)
+                if changed:
+                    new_segments += 1
+            refresh_newest()
+        else:
+            if segment_list is None:
+                try:
+                    segment_list = open(os.path.join(OUTPUT_DIR, SEGMENT_LIST_NAME), "rb")
+                except FileNotFoundError:
+                    pass
+
+            # Closed segments come from ffmpeg's list; the folder is only
+            # rescanned to find the next segment once the current one stops growing.
+            closed = read_segment_list(segment_list) if segment_list is not None else []
+            new_segments = sum(index_segment(output_base, name) for name in closed)
+            if closed or not refresh_newest():
+                new_segments += update_index(OUTPUT_DIR)
 
         # If FFmpeg died, log and restart
         if proc.poll() is not None:
-            stderr_tail = tail_stderr(proc)
-            print("[health] FFmpeg exited. stderr tail:\n" + (stderr_tail or "(no stderr)"))
+            stderr_tail = tail_stderr(stderr_ring, stderr_reader)
+            log.warning("[health] FFmpeg exited. stderr tail:\n%s", stderr_tail or "(no stderr)")
 
             status = {
                 "recording": False,
@@ -252,25 +825,24 @@ def main():
                 "ffmpeg_pid": None,
                 "ffmpeg_stderr_tail": stderr_tail,
             }
-            write_status(OUTPUT_DIR, status)
+            write_status(status_files, status)
+            last_state = None
 
             time.sleep(RESTART_BACKOFF_SECONDS)
-            proc = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
-            print("[health] Restarted FFmpeg.")
+            proc, stderr_ring, stderr_reader, progress = start_ffmpeg(ffmpeg_cmd)
+            tune_ffmpeg_process(proc.pid)
+            ffmpeg_psutil = open_process_handle(proc.pid) if resource_log else None
+            log.info("[health] Restarted FFmpeg.")
             last_ok_time = time.time()
             continue
 
         # Health check: are new segments being written?
-        newest_mtime = newest_recording_mtime(OUTPUT_DIR)
-        now = time.time()
+        newest_mtime = _index[-1][1] if _index else None
+        now_ns = time.time_ns()
+        now = now_ns / 1e9
 
-        if newest_mtime is not None and (now - newest_mtime) <= NO_PROGRESS_TIMEOUT_SECONDS:
+        # Integer ns comparison; converted to seconds only for status.json
+        if newest_mtime is not None and (now_ns - newest_mtime) <= no_progress_timeout_ns:
             healthy = True
             reason = "ok"
             last_ok_time = now
@@ -278,20 +850,25 @@ def main():
             healthy = False
             reason = "no_new_segments"
 
-        deleted = enforce_storage_cap(OUTPUT_DIR, max_bytes)
-        folder_bytes = folder_size_bytes(OUTPUT_DIR)
+        deleted = enforce_storage_cap(output_base, max_bytes)
+        folder_bytes = folder_size_bytes()
 
         # Optional: CPU/RAM usage reporting
         cpu = None
         mem_mb = None
-        if ENABLE_RESOURCE_LOG:
+        if resource_log:
+            if ffmpeg_psutil is None:
+                ffmpeg_psutil = open_process_handle(proc.pid)
             try:
-                p = psutil.Process(proc.pid)
-                cpu = p.cpu_percent(interval=None)
-                mem_mb = p.memory_info().rss / (1024 * 1024)
+                if ffmpeg_psutil is not None:
+                    cpu = ffmpeg_psutil.cpu_percent(interval=None)
+                    mem_mb = ffmpeg_psutil.memory_info().rss / _MB
+            except psutil.NoSuchProcess:
+                ffmpeg_psutil = None
             except Exception:
                 pass
 
+        out_time_us = progress.get("out_time_us")
         status = {
             "recording": healthy,
             "reason": reason,
@@ -299,22 +876,32 @@ def main():
             "rtsp_transport": RTSP_TRANSPORT,
             "segment_seconds": SEGMENT_SECONDS,
             "max_storage_gb": MAX_STORAGE_GB,
-            "output_dir": os.path.abspath(OUTPUT_DIR),
+            "output_dir": output_dir_abs,
             "folder_size_bytes": folder_bytes,
-            "newest_segment_mtime": newest_mtime,
+            "newest_segment_mtime": newest_mtime / 1e9 if newest_mtime is not None else None,
             "seconds_since_last_ok": round(now - last_ok_time, 1),
             "ffmpeg_pid": proc.pid,
+            "ffmpeg_frame": progress.get("frame"),
+            "ffmpeg_drop_frames": progress.get("drop_frames"),
+            "ffmpeg_out_time_ms": out_time_us // 1000 if out_time_us is not None else None,
+            "ffmpeg_speed": progress.get("speed"),
             "ffmpeg_cpu_percent": cpu,
             "ffmpeg_mem_mb": mem_mb,
             "deleted_files_this_check": deleted,
         }
-        write_status(OUTPUT_DIR, status)
+        # Only touch status.json when health flips or the segment set changed
+        if (healthy, reason) != last_state or new_segments or deleted:
+            write_status(status_files, status)
+            last_state = (healthy, reason)
 
         # Friendly log line
-        msg = f"[health] recording={healthy} reason={reason} folder={folder_bytes/1024/1024:.1f}MB"
-        if mem_mb is not None:
-            msg += f" cpu={cpu} mem={mem_mb:.1f}MB"
-        print(msg)
+        if log.isEnabledFor(logging.INFO):
+            frame = progress.get("frame")
+            drops = progress.get("drop_frames")
+            if mem_mb is not None:
+                log.info(_HEALTH_LOG_RES, healthy, reason, folder_bytes / _MB, frame, drops, cpu, mem_mb)
+            else:
+                log.info(_HEALTH_LOG_PROGRESS, healthy, reason, folder_bytes / _MB, frame, drops)
 
 
 if __name__ == "__main__":